@@ -0,0 +1,146 @@
+# Copyright Google
+
+# BSD License
+
+# Totals for IRS form 8949, per box and symbol.
+#
+# The holding period uses the buy date of the output lots, which for
+# replacement lots has already been moved back by the holding period of the
+# loss that was washed into them, so a replacement can become long-term.
+#
+# Example, from the output of wash.py:
+# python form8949.py out.csv -o summary.json
+
+import argparse
+import collections
+import csv
+import json
+import lot
+
+# Box used for short-term sales, by how they were reported on form 1099-B.
+# The long-term box is three letters later: A -> D, B -> E, C -> F.
+BOX_BASIS_REPORTED = 'A'
+BOX_BASIS_NOT_REPORTED = 'B'
+BOX_NO_1099B = 'C'
+
+def one_year_after(buydate):
+  # Sales after this date are long-term
+  if buydate.month == 2 and buydate.day == 29:
+    return buydate.replace(year=buydate.year + 1, day=28)
+  return buydate.replace(year=buydate.year + 1)
+
+def long_term_box(short_term_box):
+  return chr(ord(short_term_box) + 3)
+
+class Rollup(object):
+  """Count, proceeds, basis, adjustment and gain of the lots in a group."""
+  def __init__(self, box, symbol):
+    self.box = box
+    self.symbol = symbol
+    self.lots = 0
+    self.count = 0
+    self.proceeds = 0.0
+    self.basis = 0.0
+    self.adjustment = 0.0
+
+  def add(self, sold_lot):
+    self.lots += 1
+    self.count += sold_lot.count
+    self.proceeds += sold_lot.proceeds
+    self.basis += sold_lot.basis
+    self.adjustment += sold_lot.adjustment or 0.0
+
+  def merge(self, other):
+    self.lots += other.lots
+    self.count += other.count
+    self.proceeds += other.proceeds
+    self.basis += other.basis
+    self.adjustment += other.adjustment
+
+  def gain(self):
+    return self.proceeds - self.basis + self.adjustment
+
+  def term(self):
+    return 'Long' if self.box in 'DEF' else 'Short'
+
+  @staticmethod
+  def csv_headers():
+    return ['Box', 'Term', 'Symbol', 'Lots', 'Count', 'Proceeds',
+            'Cost Basis', 'Adjustment Amount', 'Gain']
+
+  def csv_row(self):
+    return [self.box, self.term(), self.symbol, self.lots, self.count,
+            round(self.proceeds, 3), round(self.basis, 3),
+            round(self.adjustment, 3), round(self.gain(), 3)]
+
+def rollup(lots, short_term_box=BOX_BASIS_REPORTED):
+  """Returns Rollups of the sold lots, per box and symbol, followed by one
+  per box for all symbols (symbol 'Total'), sorted by box and symbol."""
+  boxes = {False: short_term_box, True: long_term_box(short_term_box)}
+  # Few distinct buy dates compared to lots, so compute each anniversary once
+  anniversaries = {}
+  groups = {}
+  for elt in lots:
+    if elt.selldate is None:
+      continue
+    anniversary = anniversaries.get(elt.buydate)
+    if anniversary is None:
+      anniversary = anniversaries[elt.buydate] = one_year_after(elt.buydate)
+    key = (boxes[elt.selldate > anniversary], elt.symbol)
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = Rollup(*key)
+    group.add(elt)
+
+  ret = []
+  for key in sorted(groups):
+    if not ret or ret[-1].box != key[0]:
+      total = Rollup(key[0], 'Total')
+      ret.append(total)
+    ret.insert(-1, groups[key])
+    total.merge(groups[key])
+  return ret
+
+def save_rollups(rollups, openfile):
+  writer = csv.writer(openfile)
+  writer.writerow(Rollup.csv_headers())
+  for group in rollups:
+    writer.writerow(group.csv_row())
+
+def save_rollups_json(rollups, openfile):
+  json.dump([collections.OrderedDict(zip(Rollup.csv_headers(),
+                                        group.csv_row()))
+             for group in rollups], openfile, indent=2)
+
+def save_summary(rollups, file_name):
+  # JSON if file_name ends with .json, CSV otherwise
+  if file_name.endswith('.json'):
+    save_rollups_json(rollups, open(file_name, 'w'))
+  else:
+    save_rollups(rollups, open(file_name, 'w'))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('in_file', help='Lots, e.g. the output of wash.py')
+  parser.add_argument('-o', '--out_file',
+                      help='CSV, or JSON if the name ends with .json')
+  parser.add_argument('-b', '--box', default=BOX_BASIS_REPORTED,
+                      choices=[BOX_BASIS_REPORTED, BOX_BASIS_NOT_REPORTED,
+                               BOX_NO_1099B],
+                      help='''Box for short-term sales, A if the basis was
+                      reported to the IRS, B if not, C without form 1099-B.
+                      Long-term sales use D, E or F.''')
+  parsed = parser.parse_args()
+
+  rollups = rollup(lot.load_lots(open(parsed.in_file)), parsed.box)
+  for group in rollups:
+    print ("%s %-5s %-8s Count %d Proceeds %.3f Basis %.3f Adj %.3f "
+           "Gain %.3f" % (group.box, group.term(), group.symbol, group.count,
+                          group.proceeds, group.basis, group.adjustment,
+                          group.gain()))
+  if parsed.out_file:
+    print 'Saving summary to', parsed.out_file
+    save_summary(rollups, parsed.out_file)
+
+if __name__ == "__main__":
+  main()
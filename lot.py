@@ -18,7 +18,8 @@ class Lot(object):
                form_position = '',
                original_form_position = '',
                buy_lot = '',
-               is_replacement = False):
+               is_replacement = False,
+               account = ''):
     self.count = count
     self.symbol = symbol
     self.description = description
@@ -32,6 +33,8 @@ class Lot(object):
     self.original_form_position = self.form_position = form_position
     self.buy_lot = buy_lot
     self.is_replacement = is_replacement
+    # Name of the account holding the lot, when several are washed together
+    self.account = account
 
   @staticmethod
   def str_to_float(f):
@@ -111,7 +114,11 @@ class Lot(object):
     replacement = ''
     if self.is_replacement:
       replacement = ' [IsRepl]'
-    return front + sell + code + position + ' ' + self.buy_lot + replacement
+    account = ''
+    if self.account:
+      account = ' (%s)' % self.account
+    return (front + sell + code + position + ' ' + self.buy_lot + replacement +
+            account)
   __repr__ = __str__
 
 def save_lots(lots, openfile):
@@ -121,8 +128,12 @@ def save_lots(lots, openfile):
   for lot in lots:
     writer.writerow(lot.csv_row())
 
-def load_lots(openfile):
-  # Load the lots out from openfile, which should be a readable file object
+def load_lots(openfile, buy_lot_prefix=''):
+  # Load the lots out from openfile, which should be a readable file object.
+  # buy_lot_prefix is put in front of every BuyLot, which keeps them apart
+  # from the BuyLots of another file loaded in the same run. BuyLots that
+  # already have one (a ':'), e.g. in the output of an earlier run, are kept
+  # as they are, so they still match the same buy lot in other files.
   reader = csv.reader(openfile)
   ret = []
   buy_num = 1
@@ -132,8 +143,33 @@ def load_lots(openfile):
     ret.append(Lot.create_from_csv_row(row, str(buy_num)))
     if ret[-1].buy_lot == str(buy_num):
       buy_num = buy_num + 1
+    if buy_lot_prefix:
+      ret[-1].buy_lot = ','.join(
+          buy_lot if ':' in buy_lot else buy_lot_prefix + buy_lot
+          for buy_lot in ret[-1].buy_lot.split(','))
   return ret
 
+def load_household(accounts):
+  """Load the lots of several accounts into one list.
+
+  accounts is a list of (account name, readable file object). Each lot is
+  tagged with its account, and BuyLots are prefixed with the account name
+  since each file numbers its own buy lots."""
+  ret = []
+  for account, openfile in accounts:
+    lots = load_lots(openfile, buy_lot_prefix=account + ':')
+    for lot in lots:
+      lot.account = account
+    ret.extend(lots)
+  return ret
+
+def split_by_account(lots, accounts):
+  # Returns a list with the lots of each of the accounts, in the same order.
+  ret = dict((account, []) for account in accounts)
+  for lot in lots:
+    ret[lot.account].append(lot)
+  return [ret[account] for account in accounts]
+
 # Ways to sort lots
 def cmp_by_original_form_position(lot_a, lot_b):
   if lot_a.original_form_position != lot_b.original_form_position:
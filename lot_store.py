@@ -0,0 +1,225 @@
+# Copyright Google
+
+# BSD License
+
+# Keeps lots in a SQLite file instead of memory, for histories too large to
+# load at once. Lots are kept in symbol groups: all symbols in a group are
+# considered substantially identical, and groups are washed independently, so
+# only one group has to be in memory at a time. The wash itself runs in
+# memory with perform_wash, so memory use is bounded by the largest group.
+#
+# Example:
+# python lot_store.py lots.db import -g GOOG goog.csv
+# python lot_store.py lots.db import -g XYZ xyz.csv
+# python lot_store.py lots.db wash
+# python lot_store.py lots.db export -g GOOG goog_out.csv
+#
+# Each group is washed and saved in one transaction, so if the wash is
+# interrupted, running it again continues with the groups not yet washed.
+
+import argparse
+import datetime
+import lot
+import progress_logger
+import sqlite3
+import wash
+
+# Rows are written this many at a time
+BATCH_SIZE = 10000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS lots (
+  id INTEGER PRIMARY KEY,
+  symbol_group TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  symbol TEXT,
+  description TEXT,
+  buydate TEXT NOT NULL,
+  basis REAL,
+  selldate TEXT,
+  code TEXT,
+  adjustment REAL,
+  proceeds REAL,
+  form_position TEXT,
+  original_form_position TEXT,
+  buy_lot TEXT,
+  is_replacement INTEGER NOT NULL,
+  account TEXT
+);
+CREATE INDEX IF NOT EXISTS lots_original_form_position
+  ON lots (symbol_group, original_form_position);
+CREATE TABLE IF NOT EXISTS symbol_groups (
+  symbol_group TEXT PRIMARY KEY,
+  washed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS imports (
+  id INTEGER PRIMARY KEY,
+  symbol_group TEXT NOT NULL,
+  file_name TEXT
+);
+'''
+
+_COLUMNS = ('count, symbol, description, buydate, basis, selldate, code, '
+            'adjustment, proceeds, form_position, original_form_position, '
+            'buy_lot, is_replacement, account')
+
+def _date_to_str(date):
+  return None if date is None else date.isoformat()
+
+def _str_to_date(text):
+  if text is None:
+    return None
+  return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+def _lot_to_row(group, elt):
+  return (group, elt.count, elt.symbol, elt.description,
+          _date_to_str(elt.buydate), elt.basis, _date_to_str(elt.selldate),
+          elt.code, elt.adjustment, elt.proceeds, elt.form_position,
+          elt.original_form_position, elt.buy_lot, int(elt.is_replacement),
+          elt.account)
+
+def _row_to_lot(row):
+  ret = lot.Lot(row[0], row[1], row[2], _str_to_date(row[3]), row[4],
+                selldate=_str_to_date(row[5]), code=row[6],
+                adjustment=row[7], proceeds=row[8],
+                buy_lot=row[11], is_replacement=bool(row[12]),
+                account=row[13])
+  ret.form_position = row[9]
+  ret.original_form_position = row[10]
+  return ret
+
+class LotStore(object):
+  """Lots kept in a SQLite file, by symbol group."""
+  def __init__(self, path):
+    self.connection = sqlite3.connect(path)
+    # Same str values as lots loaded from CSV files
+    self.connection.text_factory = str
+    self.connection.executescript(_SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def groups(self, washed=None):
+    # Returns the symbol groups, optionally only the (not) washed ones.
+    query = 'SELECT symbol_group FROM symbol_groups'
+    args = ()
+    if washed is not None:
+      query += ' WHERE washed = ?'
+      args = (int(washed),)
+    return [row[0] for row in
+            self.connection.execute(query + ' ORDER BY symbol_group', args)]
+
+  def _insert(self, group, lots):
+    batch = []
+    for elt in lots:
+      batch.append(_lot_to_row(group, elt))
+      if len(batch) == BATCH_SIZE:
+        self._insert_rows(batch)
+        batch = []
+    if batch:
+      self._insert_rows(batch)
+
+  def _insert_rows(self, rows):
+    self.connection.executemany(
+        'INSERT INTO lots (symbol_group, %s) VALUES (%s)' %
+        (_COLUMNS, ', '.join(['?'] * (_COLUMNS.count(',') + 2))), rows)
+
+  def add_import(self, group, file_name):
+    # Returns a number that is unique to this import, for BuyLot prefixes.
+    with self.connection:
+      return self.connection.execute(
+          'INSERT INTO imports (symbol_group, file_name) VALUES (?, ?)',
+          (group, file_name)).lastrowid
+
+  def add_lots(self, group, lots):
+    # Adds lots to a group that has not been washed yet.
+    assert group not in self.groups(washed=True), \
+        'Group %r has already been washed' % group
+    with self.connection:
+      self.connection.execute(
+          'INSERT OR REPLACE INTO symbol_groups VALUES (?, 0)', (group,))
+      self._insert(group, lots)
+
+  def save_lots(self, group, lots, washed=False):
+    # Replaces all the lots of the group, in one transaction.
+    with self.connection:
+      self.connection.execute('DELETE FROM lots WHERE symbol_group = ?',
+                              (group,))
+      self.connection.execute(
+          'INSERT OR REPLACE INTO symbol_groups VALUES (?, ?)',
+          (group, int(washed)))
+      self._insert(group, lots)
+
+  def _select(self, where, args):
+    # In the order they were added; perform_wash sorts them itself.
+    cursor = self.connection.execute(
+        'SELECT %s FROM lots WHERE %s ORDER BY id' % (_COLUMNS, where), args)
+    while True:
+      rows = cursor.fetchmany(BATCH_SIZE)
+      if not rows:
+        break
+      for row in rows:
+        yield _row_to_lot(row)
+
+  def load_lots(self, group):
+    return list(self._select('symbol_group = ?', (group,)))
+
+  def load_lots_with_original_form_position(self, group, form_position):
+    # The lots that were split from the lot at form_position
+    return list(self._select(
+        'symbol_group = ? AND original_form_position = ?',
+        (group, form_position)))
+
+def wash_groups(store, logger):
+  """Washes every group of store that has not been washed yet.
+
+  Returns the groups washed."""
+  groups = store.groups(washed=False)
+  for group in groups:
+    lots = store.load_lots(group)
+    if lots:
+      lots = wash.perform_wash(lots, logger)
+    store.save_lots(group, lots, washed=True)
+  return groups
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('store', metavar='store_file')
+  commands = parser.add_subparsers(dest='command')
+  import_command = commands.add_parser(
+      'import', help='Add the lots of a CSV file to a symbol group')
+  import_command.add_argument('-g', '--group', default='')
+  import_command.add_argument('in_file')
+  commands.add_parser('wash', help='Wash every group not washed yet')
+  export_command = commands.add_parser(
+      'export', help='Save the lots of a symbol group to a CSV file')
+  export_command.add_argument('-g', '--group', default='')
+  export_command.add_argument('-f', '--form_position',
+                              help='Only the lots split from this lot')
+  export_command.add_argument('out_file')
+  parsed = parser.parse_args()
+
+  store = LotStore(parsed.store)
+  if parsed.command == 'import':
+    # Each file numbers its own buy lots from 1, so they are prefixed with
+    # the number of the import
+    prefix = '%d:' % store.add_import(parsed.group, parsed.in_file)
+    lots = lot.load_lots(open(parsed.in_file), buy_lot_prefix=prefix)
+    store.add_lots(parsed.group, lots)
+    print 'Added %d lots to group %r' % (len(lots), parsed.group)
+  elif parsed.command == 'wash':
+    for group in wash_groups(store, progress_logger.NullLogger()):
+      print 'Washed group %r' % group
+  elif parsed.command == 'export':
+    if parsed.form_position is not None:
+      lots = store.load_lots_with_original_form_position(
+          parsed.group, parsed.form_position)
+    else:
+      lots = store.load_lots(parsed.group)
+    lots.sort(cmp=wash.cmp_by_sell_date)
+    print 'Saving %d lots to %s' % (len(lots), parsed.out_file)
+    lot.save_lots(lots, open(parsed.out_file, 'w'))
+  store.close()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,187 @@
+# Copyright Google
+
+# BSD License
+
+import argparse
+import array
+import csv
+
+class Provenance(object):
+  """Compact record of which loss washed into which replacement.
+
+  Every lot seen by perform_wash is a node. Splitting a lot creates two new
+  nodes whose parent is the node that was split. Pairing a loss with a
+  replacement records, on the replacement node, the loss node it absorbed,
+  the number of shares, the basis added and the days the buy date moved
+  back. A lot can be a replacement only once, so one slot per node is enough.
+  All columns are flat arrays indexed by node number.
+  """
+  def __init__(self):
+    self.form_positions = []
+    self.accounts = []
+    self.parent = array.array('l')
+    self.washed_from = array.array('l')
+    self.shares = array.array('l')
+    self.basis_shift = array.array('d')
+    self.days_shift = array.array('l')
+    # Only valid during a run: maps id(lot) to the lot's current node.
+    self._lot_nodes = {}
+    # Built on the first find(): maps (form position, account) to its last
+    # node.
+    self._positions = None
+
+  def __len__(self):
+    return len(self.parent)
+
+  def _new_node(self, form_position, account, parent):
+    self._positions = None
+    self.form_positions.append(form_position)
+    self.accounts.append(account)
+    self.parent.append(parent)
+    self.washed_from.append(-1)
+    self.shares.append(0)
+    self.basis_shift.append(0.0)
+    self.days_shift.append(0)
+    return len(self.parent) - 1
+
+  def node_for(self, lot):
+    # Returns the node for lot, creating a root node if it is not known yet.
+    node = self._lot_nodes.get(id(lot))
+    if node is None:
+      node = self._new_node(lot.form_position, lot.account, -1)
+      self._lot_nodes[id(lot)] = node
+    return node
+
+  def add_lots(self, lots):
+    for lot in lots:
+      self.node_for(lot)
+
+  def record_split(self, head, rest):
+    # Called after split_head_lot: rest is the original lot object, which
+    # now holds the remaining shares, head is the newly created lot.
+    parent = self.node_for(rest)
+    self._lot_nodes[id(head)] = self._new_node(head.form_position,
+                                               head.account, parent)
+    self._lot_nodes[id(rest)] = self._new_node(rest.form_position,
+                                               rest.account, parent)
+
+  def record_copy(self, copy, lot):
+    # copy replaces lot from now on, see perform_wash's shared argument.
+    self._lot_nodes[id(copy)] = self.node_for(lot)
+
+  def record_wash(self, loss, buy, adjusted=True):
+    # Called once the loss has been paired with the replacement buy. If
+    # adjusted is False, the buy kept its basis and buy date (a buy in a
+    # tax-advantaged account).
+    node = self.node_for(buy)
+    assert self.washed_from[node] == -1
+    self.washed_from[node] = self.node_for(loss)
+    self.shares[node] = loss.count
+    if adjusted:
+      self.basis_shift[node] = loss.basis - loss.proceeds
+      self.days_shift[node] = (loss.selldate - loss.buydate).days
+
+  def find(self, form_position, account=''):
+    """Returns the last node with form_position in account, or -1.
+
+    Split lots get a new node, so the last one is the lot as it was written
+    to the output. Each account has its own form positions."""
+    if self._positions is None:
+      self._positions = dict(
+          (key, node) for node, key
+          in enumerate(zip(self.form_positions, self.accounts)))
+    return self._positions.get((form_position, account), -1)
+
+  def ancestry(self, node):
+    """Returns the replacement nodes that explain node's basis, nearest first.
+
+    For each returned node, washed_from, shares, basis_shift and days_shift
+    describe the loss that was washed into it."""
+    ret = []
+    while node != -1:
+      if self.washed_from[node] != -1:
+        ret.append(node)
+        node = self.washed_from[node]
+      else:
+        node = self.parent[node]
+    return ret
+
+  @staticmethod
+  def csv_headers():
+    return ['Node', 'FormPosition', 'Account', 'Parent', 'WashedFrom',
+            'Shares', 'BasisShift', 'HoldingDaysShift']
+
+  def csv_row(self, node):
+    def optional(value):
+      return '' if value == -1 else value
+    washed = self.washed_from[node] != -1
+    return [node, self.form_positions[node], self.accounts[node],
+            optional(self.parent[node]),
+            optional(self.washed_from[node]),
+            self.shares[node] if washed else '',
+            round(self.basis_shift[node], 3) if washed else '',
+            self.days_shift[node] if washed else '']
+
+  def _label(self, node):
+    # Form position, followed by the account if there is one
+    if self.accounts[node]:
+      return '%s (%s)' % (self.form_positions[node], self.accounts[node])
+    return self.form_positions[node]
+
+  def describe(self, node):
+    # Human readable ancestry of node.
+    lines = ['%s (node %d)' % (self._label(node), node)]
+    for repl in self.ancestry(node):
+      loss = self.washed_from[repl]
+      lines.append('  %s absorbed %d shares from %s: basis +%.3f, '
+                   'acquired %d days earlier' %
+                   (self._label(repl), self.shares[repl],
+                    self._label(loss), self.basis_shift[repl],
+                    self.days_shift[repl]))
+    return '\n'.join(lines)
+
+def save_provenance(provenance, openfile):
+  # Write the provenance table to openfile which should be writeable
+  writer = csv.writer(openfile)
+  writer.writerow(Provenance.csv_headers())
+  for node in xrange(len(provenance)):
+    writer.writerow(provenance.csv_row(node))
+
+def load_provenance(openfile):
+  # Load a provenance table from openfile, which should be readable
+  def optional(value, default):
+    return default if value == '' else value
+  reader = csv.reader(openfile)
+  ret = Provenance()
+  for row in reader:
+    if row[0] == Provenance.csv_headers()[0]:
+      continue
+    assert int(row[0]) == len(ret)
+    node = ret._new_node(row[1], row[2], int(optional(row[3], -1)))
+    if row[4] != '':
+      ret.washed_from[node] = int(row[4])
+      ret.shares[node] = int(row[5])
+      ret.basis_shift[node] = float(row[6])
+      ret.days_shift[node] = int(row[7])
+  return ret
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Explain the basis of lots using a provenance file '
+      'written by wash.py -p')
+  parser.add_argument('provenance_file')
+  parser.add_argument('-a', '--account', default='',
+                      help='Account of the lots, if washed with wash.py -a')
+  parser.add_argument('form_positions', nargs='+', metavar='form_position')
+  parsed = parser.parse_args()
+
+  provenance = load_provenance(open(parsed.provenance_file))
+  for form_position in parsed.form_positions:
+    node = provenance.find(form_position, parsed.account)
+    if node == -1:
+      print 'Not found:', form_position
+      continue
+    print provenance.describe(node)
+
+if __name__ == "__main__":
+  main()
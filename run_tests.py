@@ -12,18 +12,103 @@
 #
 # The tests/rounded folder contains the tests using the -r round option:
 # python ../wash.py -w {input}.csv -q -r -o rounded/{input}_out.csv
+#
+# The tests/provenance folder contains the provenance tables from the -p option:
+# python ../wash.py -w {input}.csv -q -p provenance/{input}_out.csv
+#
+# The tests/form8949 folder contains the form 8949 totals from the -s option:
+# python ../wash.py -w {input}.csv -q -s form8949/{input}_out.csv
+# and in tests/form8949/merged, with the -m merge option:
+# python ../wash.py -w {input}.csv -q -m -s form8949/merged/{input}_out.csv
+#
+# The tests/highest_basis and tests/broker folders contain the tests using
+# the --policy option of the same name:
+# python ../wash.py -w {input}.csv -q --policy {policy} -o {policy}/{input}_out.csv
+#
+# The tests/scenario folder contains a base, trade plans to evaluate against
+# it, and plans that must be rejected:
+# python ../../scenario.py -b base.csv -o results_out.csv plans/*.csv
+# Each plan in tests/scenario/invalid has a .txt file with the start of the
+# error it must raise.
+#
+# Each folder in tests/household holds one input file per account, washed
+# together, and the reference output of each account:
+# python ../../../wash.py -q -a {account} {account}.csv ... -o out.csv
+# then rename out_{account}.csv to {account}_out.csv
+# The optional provenance_out.csv is the provenance table from the -p option,
+# and the optional tax_advantaged.txt lists the accounts to give with -i.
 
+import form8949
 import inspect
 import lot
+import lot_store
 import os
 import progress_logger
+import provenance
+import scenario
+import shutil
 import StringIO
+import sys
+import tempfile
 import wash
 
+class Interrupted(Exception):
+  pass
+
+class InterruptedLotStore(lot_store.LotStore):
+  # Fails once after writing lots of interrupted_group, before the end of
+  # the transaction.
+  interrupted_group = None
+
+  def _insert(self, group, lots):
+    lot_store.LotStore._insert(self, group, lots)
+    if group == self.interrupted_group:
+      self.interrupted_group = None
+      raise Interrupted()
+
+def lots_csv(lots):
+  # lots as CSV text, sorted by buy date
+  out_csv = StringIO.StringIO()
+  lot.save_lots(sorted(lots, cmp=wash.cmp_by_buy_date), out_csv)
+  return out_csv.getvalue()
+
 def run_test(input_csv, expected_out_csv, merge_split_lots=False,
-        rounded_dollars=False):
+        rounded_dollars=False, shared_input=False, sqlite_store=False,
+        policy=None):
   lots = lot.load_lots(open(input_csv))
-  out = wash.perform_wash(lots, progress_logger.NullLogger())
+  if sqlite_store:
+    # The wash of the second group is interrupted once, while saving it,
+    # and then resumed
+    store = InterruptedLotStore(':memory:')
+    store.add_lots('first', lots)
+    store.add_lots('test', lots)
+    store.interrupted_group = 'test'
+    try:
+      lot_store.wash_groups(store, progress_logger.NullLogger())
+      assert False, 'not interrupted'
+    except Interrupted:
+      pass
+    assert store.groups(washed=False) == ['test']
+    assert lots_csv(store.load_lots('test')) == lots_csv(lots)
+    assert lot_store.wash_groups(store, progress_logger.NullLogger()) == \
+        ['test']
+    out = store.load_lots('test')
+    assert lots_csv(store.load_lots('first')) == lots_csv(out)
+    store.close()
+  elif shared_input:
+    # The wash must copy the input lots it changes, and leave these alone
+    input_csv_before = StringIO.StringIO()
+    lot.save_lots(lots, input_csv_before)
+    shared = set(id(elt) for elt in lots)
+    out = wash.perform_wash(list(lots), progress_logger.NullLogger(),
+                            shared=shared)
+    input_csv_after = StringIO.StringIO()
+    lot.save_lots(lots, input_csv_after)
+    assert input_csv_before.getvalue() == input_csv_after.getvalue()
+  else:
+    policy_class = wash.POLICIES.get(policy, wash.ChronologicalPolicy)
+    out = wash.perform_wash(lots, progress_logger.NullLogger(),
+                            policy=policy_class())
   out.sort(cmp=wash.cmp_by_buy_date)
 
   # merge split lots back together, if asked.
@@ -47,6 +132,9 @@ def run_test(input_csv, expected_out_csv, merge_split_lots=False,
   # Report pass/fail
   mods = "(merged split-lots) " if merge_split_lots else ""
   mods += "(safe for whole-dollar arithmetic) " if rounded_dollars else ""
+  mods += "(shared input lots) " if shared_input else ""
+  mods += "(sqlite store) " if sqlite_store else ""
+  mods += "(%s policy) " % policy if policy else ""
   # lot.__eq__ compares all members, including original_form_position
   # and will also include any future internal data members. So, to compare
   # the test vs expected, we use the output CSV file for both, which should
@@ -60,6 +148,175 @@ def run_test(input_csv, expected_out_csv, merge_split_lots=False,
   else:
     print "%sTest passed: %s" % (mods, input_csv)
 
+def run_provenance_test(input_csv, expected_provenance_csv):
+  lots = lot.load_lots(open(input_csv))
+  table = provenance.Provenance()
+  wash.perform_wash(lots, progress_logger.NullLogger(), table)
+  out_csv = StringIO.StringIO()
+  provenance.save_provenance(table, out_csv)
+
+  expected = provenance.load_provenance(open(expected_provenance_csv))
+  expected_csv = StringIO.StringIO()
+  provenance.save_provenance(expected, expected_csv)
+
+  if out_csv.getvalue() != expected_csv.getvalue():
+    print "****\n(provenance) Test failed: %s" % input_csv
+    print "Got result:"
+    print out_csv.getvalue()
+    print "\nExpected output:", expected_provenance_csv
+    print expected_csv.getvalue()
+  else:
+    print "(provenance) Test passed: %s" % input_csv
+
+def run_form8949_test(input_csv, expected_summary_csv, merge_split_lots=False):
+  out_csv = StringIO.StringIO()
+  if merge_split_lots:
+    # Through wash.py -m -s, which must total the lots before merging them
+    summary_dir = tempfile.mkdtemp()
+    summary_csv = os.path.join(summary_dir, 'summary.csv')
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = ['wash.py', '-w', input_csv, '-q', '-m', '-s', summary_csv]
+    sys.stdout = StringIO.StringIO()
+    try:
+      wash.main()
+    finally:
+      sys.argv, sys.stdout = argv, stdout
+    out_csv.write(open(summary_csv).read())
+    shutil.rmtree(summary_dir)
+  else:
+    lots = lot.load_lots(open(input_csv))
+    out = wash.perform_wash(lots, progress_logger.NullLogger())
+    form8949.save_rollups(form8949.rollup(out), out_csv)
+
+  mods = "(merged split-lots) " if merge_split_lots else ""
+  expected_csv = open(expected_summary_csv).read()
+  if out_csv.getvalue().splitlines() != expected_csv.splitlines():
+    print "****\n%s(form 8949) Test failed: %s" % (mods, input_csv)
+    print "Got result:"
+    print out_csv.getvalue()
+    print "\nExpected output:", expected_summary_csv
+    print expected_csv
+  else:
+    print "%s(form 8949) Test passed: %s" % (mods, input_csv)
+
+def run_household_test(household_dir):
+  accounts = sorted(name.rsplit('.', 1)[0]
+                    for name in os.listdir(household_dir)
+                    if name.endswith(".csv") and not name.endswith("_out.csv"))
+  lots = lot.load_household([
+      (account, open(os.path.join(household_dir, account + '.csv')))
+      for account in accounts])
+  # tax_advantaged.txt lists the tax-advantaged accounts, one per line
+  tax_advantaged_txt = os.path.join(household_dir, 'tax_advantaged.txt')
+  tax_advantaged = frozenset()
+  if os.path.exists(tax_advantaged_txt):
+    tax_advantaged = frozenset(open(tax_advantaged_txt).read().split())
+  table = provenance.Provenance()
+  out = wash.perform_wash(lots, progress_logger.NullLogger(), table,
+                          tax_advantaged=tax_advantaged)
+
+  failed = False
+  account_csvs = []
+  for account, account_lots in zip(accounts,
+                                   lot.split_by_account(out, accounts)):
+    account_lots.sort(cmp=wash.cmp_by_buy_date)
+    out_csv = StringIO.StringIO()
+    lot.save_lots(account_lots, out_csv)
+    account_csvs.append(out_csv.getvalue())
+
+    expected_out_csv = os.path.join(household_dir, account + '_out.csv')
+    expected = lot.load_lots(open(expected_out_csv))
+    expected.sort(cmp=wash.cmp_by_buy_date)
+    expected_csv = StringIO.StringIO()
+    lot.save_lots(expected, expected_csv)
+
+    if out_csv.getvalue() != expected_csv.getvalue():
+      failed = True
+      print "****\n(household) Test failed: %s" % household_dir
+      print "Got result for %s:" % account
+      print out_csv.getvalue()
+      print "\nExpected output:", expected_out_csv
+      print expected_csv.getvalue()
+
+    # Form positions are only unique within an account
+    for elt in account_lots:
+      node = table.find(elt.form_position, account)
+      if node == -1 or table.accounts[node] != account:
+        failed = True
+        print "****\n(household) Test failed: %s" % household_dir
+        print "Provenance not found for %s: %s" % (account, elt)
+
+  # Washing the output again, as when a year's output files are given back
+  # with -a, must keep the BuyLots and change nothing
+  lots = lot.load_household([(account, StringIO.StringIO(account_csv))
+                             for account, account_csv
+                             in zip(accounts, account_csvs)])
+  out = wash.perform_wash(lots, progress_logger.NullLogger(),
+                          tax_advantaged=tax_advantaged)
+  for account, account_lots, account_csv in zip(
+      accounts, lot.split_by_account(out, accounts), account_csvs):
+    if lots_csv(account_lots) != account_csv:
+      failed = True
+      print "****\n(household) Test failed: %s" % household_dir
+      print "Washing the output again changed %s:" % account
+      print lots_csv(account_lots)
+
+  expected_provenance_csv = os.path.join(household_dir, 'provenance_out.csv')
+  if os.path.exists(expected_provenance_csv):
+    out_csv = StringIO.StringIO()
+    provenance.save_provenance(table, out_csv)
+    expected_csv = open(expected_provenance_csv).read()
+    if out_csv.getvalue().splitlines() != expected_csv.splitlines():
+      failed = True
+      print "****\n(household) Test failed: %s" % household_dir
+      print "Got provenance:"
+      print out_csv.getvalue()
+      print "\nExpected provenance:", expected_provenance_csv
+      print expected_csv
+  if not failed:
+    print "(household) Test passed: %s" % household_dir
+
+def run_scenario_test(scenario_dir):
+  portfolio = scenario.Portfolio(
+      lot.load_lots(open(os.path.join(scenario_dir, 'base.csv'))))
+  plans = [('plans/' + name, lot.load_lots(
+               open(os.path.join(scenario_dir, 'plans', name)),
+               buy_lot_prefix='plan:'))
+           for name in sorted(os.listdir(os.path.join(scenario_dir, 'plans')))]
+  expected_csv = open(os.path.join(scenario_dir, 'results_out.csv')).read()
+  for jobs in [1, 2]:
+    out_csv = StringIO.StringIO()
+    scenario.save_results(scenario.evaluate_plans(portfolio, plans, jobs),
+                          out_csv)
+    if out_csv.getvalue().splitlines() != expected_csv.splitlines():
+      print "****\n(scenario, %d jobs) Test failed: %s" % (jobs, scenario_dir)
+      print "Got result:"
+      print out_csv.getvalue()
+      print "\nExpected output:", expected_csv
+    else:
+      print "(scenario, %d jobs) Test passed: %s" % (jobs, scenario_dir)
+
+  invalid_dir = os.path.join(scenario_dir, 'invalid')
+  for name in sorted(os.listdir(invalid_dir)):
+    if not name.endswith('.csv'):
+      continue
+    trades = lot.load_lots(open(os.path.join(invalid_dir, name)),
+                           buy_lot_prefix='plan:')
+    # The .txt file next to the plan has the start of the expected error
+    expected_error = open(os.path.join(
+        invalid_dir, name.rsplit('.', 1)[0] + '.txt')).read().strip()
+    try:
+      scenario.Scenario(portfolio, name, trades)
+    except ValueError as error:
+      if str(error).startswith(expected_error):
+        print "(scenario) Test passed, plan rejected: %s" % name
+      else:
+        print "****\n(scenario) Test failed: %s" % name
+        print "Got error:", error
+        print "Expected error:", expected_error
+    else:
+      print "****\n(scenario) Test failed, plan accepted: %s" % name
+
 def main():
   test_dir = os.path.join(
     os.path.dirname(inspect.getfile(inspect.currentframe())), 'tests')
@@ -73,7 +330,13 @@ def main():
     # Basic test, compute wash sale and split lots
     out_path = os.path.join(test_dir, out_name)
     run_test(test_path, out_path)
-    
+
+    # Same, without changing the input lots, as done for scenarios
+    run_test(test_path, out_path, shared_input=True)
+
+    # Same, with the lots kept in a SQLite store
+    run_test(test_path, out_path, sqlite_store=True)
+
     # Test the merging of split lots
     merged_path = os.path.join(test_dir, 'merged', out_name)
     if os.path.exists(merged_path):
@@ -84,6 +347,33 @@ def main():
     if os.path.exists(rounded_path):
       run_test(test_path, rounded_path, rounded_dollars=True)
 
+    # Test the other replacement policies
+    for policy in sorted(wash.POLICIES):
+      policy_path = os.path.join(test_dir, policy, out_name)
+      if os.path.exists(policy_path):
+        run_test(test_path, policy_path, policy=policy)
+
+    # Test the recorded wash provenance
+    provenance_path = os.path.join(test_dir, 'provenance', out_name)
+    if os.path.exists(provenance_path):
+      run_provenance_test(test_path, provenance_path)
+
+    # Test the form 8949 totals
+    form8949_path = os.path.join(test_dir, 'form8949', out_name)
+    if os.path.exists(form8949_path):
+      run_form8949_test(test_path, form8949_path)
+    form8949_merged_path = os.path.join(test_dir, 'form8949', 'merged',
+                                        out_name)
+    if os.path.exists(form8949_merged_path):
+      run_form8949_test(test_path, form8949_merged_path, merge_split_lots=True)
+
+  run_scenario_test(os.path.join(test_dir, 'scenario'))
+
+  household_dir = os.path.join(test_dir, 'household')
+  for name in os.listdir(household_dir):
+    if os.path.isdir(os.path.join(household_dir, name)):
+      run_household_test(os.path.join(household_dir, name))
+
 if __name__ == "__main__":
   main()
 
@@ -0,0 +1,187 @@
+# Copyright Google
+
+# BSD License
+
+# Evaluates many candidate trade plans against the same base portfolio.
+#
+# A plan is a CSV file in the same format as the wash.py input. A row whose
+# FormPosition names a lot of the base that has not been sold, and which has
+# a Date Sold, sells Count shares of that lot. Every other row is a new trade.
+# Sells of new trades must use FormPositions that do not look like those of
+# the base (e.g. "Plan 1" when the base uses "Line 1"), so that a mistyped
+# base lot is reported instead of being sold as a new trade.
+#
+# Example:
+# python scenario.py -b lots.csv -j 4 -o summary.csv plan_a.csv plan_b.csv
+
+import argparse
+import copy
+import csv
+import lot
+import multiprocessing
+import progress_logger
+import re
+import wash
+
+def position_pattern(form_position):
+  # Line 12.2 -> Line #.#
+  return re.sub(r'\d+', '#', form_position)
+
+class Portfolio(object):
+  """The base lots, loaded once and shared by all scenarios.
+
+  The lots are never changed: perform_wash copies a base lot only when a
+  pairing has to change it."""
+  def __init__(self, lots):
+    # Sorted the way earliest_wash_loss sorts, so that its first sort in each
+    # scenario only has to place the plan's lots.
+    self.lots = sorted(lots, cmp=wash.cmp_by_sell_date)
+    self.shared = frozenset(id(elt) for elt in self.lots)
+    self._positions = {}
+    for i, elt in enumerate(self.lots):
+      self._positions.setdefault(elt.form_position, []).append(i)
+    self._patterns = set(position_pattern(position)
+                         for position in self._positions)
+
+  def __setstate__(self, state):
+    # The lots get new ids when unpickled in another process
+    self.__dict__.update(state)
+    self.shared = frozenset(id(elt) for elt in self.lots)
+
+  def looks_like_base_lot(self, form_position):
+    return position_pattern(form_position) in self._patterns
+
+  def open_lot(self, form_position):
+    # Returns the index of the unsold base lot with form_position, or None
+    for i in self._positions.get(form_position, []):
+      if not self.lots[i].has_sell():
+        return i
+    return None
+
+class Scenario(object):
+  """A plan applied on top of a Portfolio.
+
+  Base lots sold by the plan are replaced by new lots; all the other base
+  lots are used as they are."""
+  def __init__(self, portfolio, name, trades):
+    self.portfolio = portfolio
+    self.name = name
+    self._replaced = {}
+    self._added = []
+    for trade in trades:
+      i = portfolio.open_lot(trade.form_position)
+      if i is None or not trade.has_sell():
+        if (trade.has_sell() and
+            portfolio.looks_like_base_lot(trade.form_position)):
+          raise ValueError('Not an unsold lot of the base: %s' % trade)
+        self._added.append(trade)
+      else:
+        self._sell(i, trade)
+
+  def _sell(self, i, trade):
+    held = self._replaced.pop(i, [self.portfolio.lots[i]])
+    unsold = held[-1]
+    if unsold.has_sell():
+      raise ValueError('Sold twice: %s' % trade)
+    if trade.count > unsold.count:
+      raise ValueError('Selling too many: %s' % trade)
+    if trade.count == unsold.count:
+      sold = copy.copy(unsold)
+      held[-1] = sold
+    else:
+      # Same as split_head_lot, without changing the base lot
+      pieces = [copy.copy(unsold)]
+      sold = wash.split_head_lot(pieces, trade.count)
+      held[-1:] = pieces
+    sold.selldate = trade.selldate
+    sold.proceeds = trade.proceeds
+    sold.code = trade.code
+    sold.adjustment = trade.adjustment
+    self._replaced[i] = held
+
+  def lots(self):
+    # The lots to wash. Only the plan's lots are copied, since the wash
+    # changes them; the base lots are shared.
+    ret = []
+    for i, elt in enumerate(self.portfolio.lots):
+      if i in self._replaced:
+        ret.extend(copy.copy(held) for held in self._replaced[i])
+      else:
+        ret.append(elt)
+    ret.extend(copy.copy(trade) for trade in self._added)
+    return ret
+
+  def evaluate(self):
+    """Runs the wash and returns (disallowed loss, net realized gain).
+
+    The net realized gain already adds back the disallowed losses."""
+    out = wash.perform_wash(self.lots(), progress_logger.NullLogger(),
+                            shared=self.portfolio.shared)
+    disallowed = 0.0
+    realized = 0.0
+    for elt in out:
+      if not elt.has_sell():
+        continue
+      adjustment = elt.adjustment or 0.0
+      if elt.code == 'W':
+        disallowed += adjustment
+      realized += elt.proceeds - elt.basis + adjustment
+    return disallowed, realized
+
+# The base of the current process. Worker processes set it once when they
+# start, instead of receiving it with every plan. Forked workers share it
+# with the parent; on platforms that spawn workers it is pickled once per
+# worker.
+_portfolio = None
+
+def _set_portfolio(portfolio):
+  global _portfolio
+  _portfolio = portfolio
+
+def _evaluate(plan):
+  name, trades = plan
+  return (name,) + Scenario(_portfolio, name, trades).evaluate()
+
+def evaluate_plans(portfolio, plans, jobs=1):
+  """Returns [(name, disallowed loss, net realized gain)] for each
+  (name, trades) in plans, using jobs worker processes."""
+  if jobs <= 1:
+    _set_portfolio(portfolio)
+    return [_evaluate(plan) for plan in plans]
+  pool = multiprocessing.Pool(jobs, initializer=_set_portfolio,
+                              initargs=(portfolio,))
+  try:
+    return pool.map(_evaluate, plans)
+  finally:
+    pool.close()
+    pool.join()
+
+def save_results(results, openfile):
+  writer = csv.writer(openfile)
+  writer.writerow(['Plan', 'Disallowed Loss', 'Net Realized Gain'])
+  for name, disallowed, realized in results:
+    writer.writerow([name, round(disallowed, 3), round(realized, 3)])
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-b', '--base', metavar='in_file', required=True)
+  parser.add_argument('-j', '--jobs', type=int,
+                      default=multiprocessing.cpu_count())
+  parser.add_argument('-o', '--out_file')
+  parser.add_argument('plans', nargs='+', metavar='plan_file')
+  parsed = parser.parse_args()
+
+  portfolio = Portfolio(lot.load_lots(open(parsed.base)))
+  # Keep the plan's own buy lots apart from the base ones
+  plans = [(name, lot.load_lots(open(name), buy_lot_prefix='plan:'))
+           for name in parsed.plans]
+  results = evaluate_plans(portfolio, plans, parsed.jobs)
+  for name, disallowed, realized in results:
+    print "%s: Disallowed %.3f Net realized %.3f" % (name, disallowed,
+                                                      realized)
+  if parsed.out_file:
+    print 'Saving results to', parsed.out_file
+    save_results(results, open(parsed.out_file, 'w'))
+
+if __name__ == "__main__":
+  main()
@@ -3,12 +3,16 @@
 # BSD License
 
 import argparse
+import bisect
 import copy
+import datetime
+import form8949
+import heapq
 import lot
+import os
 import progress_logger
-
-def remove_lot_from_list(lots, lot):
-  lots[:] = [elt for elt in lots if id(elt) != id(lot)]
+import provenance
+import re
 
 # Ways to sort lots
 def cmp_by_buy_date(lot_a, lot_b):
@@ -26,6 +30,10 @@ def cmp_by_buy_date(lot_a, lot_b):
     return 1
   return 0
 
+def buy_date_key(lot):
+  # Sort key giving the same order as cmp_by_buy_date
+  return (lot.buydate, lot.selldate is None, lot.selldate, lot.form_position)
+
 def cmp_by_sell_date(lot_a, lot_b):
   # Sort puts the buys without sells at the end
   if lot_a.selldate != lot_b.selldate:
@@ -56,44 +64,112 @@ def merge_buy_lots(merge_from, merge_to):
   assert(not buy_lots_match(merge_from, merge_to))
   merge_to.buy_lot += ',' + merge_from.buy_lot
 
-def buy_lots_within_window(lots, loss):
-  # Returns an array of lots that were bought within 30 days of the loss
-  def match(lot, loss):
-    if abs((lot.buydate - loss.selldate).days) > 30:
-      return False
-    if buy_lots_match(lot, loss):
-      return False
-    if lot.is_replacement:
-      return False
-    if not lot.selldate or lot.selldate > loss.selldate:
-      return True
-    if lot.selldate < loss.selldate:
-      return False
+def buy_lot_within_window(lot, loss):
+  # Returns True if lot was bought within 30 days of the loss and can
+  # replace it
+  if abs((lot.buydate - loss.selldate).days) > 30:
+    return False
+  if buy_lots_match(lot, loss):
+    return False
+  if lot.is_replacement:
+    return False
+  if not lot.selldate or lot.selldate > loss.selldate:
     return True
-  return [lot for lot in lots if match(lot, loss)]
+  if lot.selldate < loss.selldate:
+    return False
+  return True
+
+class BuyWindowIndex(object):
+  """The lots that can be replacements, sorted by buy date.
+
+  Finds the lots bought within 30 days of a loss without looking at all the
+  lots, whichever account they are in. Only valid until lots changes."""
+  def __init__(self, lots):
+    # Buy dates and positions in lots, sorted by buy date
+    entries = sorted((lot.buydate, i) for i, lot in enumerate(lots)
+                     if not lot.is_replacement)
+    self._lots = lots
+    self._dates = [buydate for buydate, _ in entries]
+    self._positions = [i for _, i in entries]
+
+  def within_window(self, loss):
+    # Returns the lots that can replace the loss, in the order of lots
+    window = datetime.timedelta(days=30)
+    start = bisect.bisect_left(self._dates, loss.selldate - window)
+    end = bisect.bisect_right(self._dates, loss.selldate + window)
+    return [self._lots[i] for i in sorted(self._positions[start:end])
+            if buy_lot_within_window(self._lots[i], loss)]
+
+def is_loss(lot, tax_advantaged):
+  # Sales in tax-advantaged accounts have no loss to wash
+  return (lot.has_sell() and lot.proceeds < lot.basis and
+          lot.account not in tax_advantaged)
 
-def earliest_wash_loss(lots):
+def earliest_wash_loss(lots, tax_advantaged=()):
+  # Returns the losses sold on the earliest day that has a wash sale, and the
+  # replacements of the first of them; (None, None) if there are none left.
+  # The window index is built once per call, after the sort it relies on.
   lots.sort(cmp=cmp_by_sell_date)
   ret = []
+  index = BuyWindowIndex(lots)
   for i, lot in enumerate(lots):
     if not lot.has_sell():
-      return None  # We're done
-    if lot.proceeds >= lot.basis:
+      break  # We're done
+    if not is_loss(lot, tax_advantaged):
       continue
-    buys = buy_lots_within_window(lots, lot)
+    buys = index.within_window(lot)
     if not buys:
       continue
     ret.append(lot)
     # Pull all the next lots w/ the same sell-date into ret if they have losses
     i = i + 1
     while i < len(lots):
-      if (lots[i].has_sell() and lots[i].proceeds < lots[i].basis and
+      if (is_loss(lots[i], tax_advantaged) and
           lots[i].selldate == ret[0].selldate):
         ret.append(lots[i])
         i = i + 1
         continue
       break
-    return ret
+    return ret, buys
+  return None, None
+
+# Replacement policies decide which of the replacements within the window
+# absorbs the earliest loss first: key(lot) returns the priority of a
+# replacement, lowest first. Losses are always taken by buy date.
+class ChronologicalPolicy(object):
+  """Earliest bought replacement first."""
+  def key(self, lot):
+    return buy_date_key(lot)
+
+class HighestBasisPolicy(object):
+  """Replacement with the highest basis per share first."""
+  def key(self, lot):
+    return (-lot.basis / lot.count, buy_date_key(lot))
+
+class BrokerOrderPolicy(object):
+  """Replacements in FormPosition order, as listed on the 1099-B.
+
+  Numbers in the FormPosition compare as numbers, so Line 2 is before
+  Line 10. Useful to reconcile with the adjustments made by the broker."""
+  def key(self, lot):
+    parts = re.split(r'(\d+)', lot.form_position)
+    parts[1::2] = [int(number) for number in parts[1::2]]
+    return (parts, buy_date_key(lot))
+
+POLICIES = {
+  'chronological': ChronologicalPolicy,
+  'highest_basis': HighestBasisPolicy,
+  'broker': BrokerOrderPolicy,
+}
+
+def lot_heap(lots, key):
+  # Heap of (key, position, lot): ties are taken in list order
+  heap = [(key(lot), i, lot) for i, lot in enumerate(lots)]
+  heapq.heapify(heap)
+  return heap
+
+def pop_lot(heap):
+  return heapq.heappop(heap)[2] if heap else None
 
 def split_head_lot(lots, ideal_head_count):
   # returns the new lot that was created
@@ -116,59 +192,129 @@ def split_head_lot(lots, ideal_head_count):
   lots.insert(0, new_lot)
   return new_lot
 
-def perform_wash(lots, logger):
+def copy_shared_lots(lots, shared, lot_lists):
+  """Replaces the lots in lot_lists whose id is in shared by copies, in
+  lot_lists and in lots. Returns (copy, original) pairs."""
+  copies = {}
+  for lot_list in lot_lists:
+    for i, elt in enumerate(lot_list):
+      if id(elt) not in shared:
+        continue
+      if id(elt) not in copies:
+        copies[id(elt)] = copy.copy(elt)
+      lot_list[i] = copies[id(elt)]
+  if not copies:
+    return []
+  ret = []
+  for i, elt in enumerate(lots):
+    if id(elt) in copies:
+      ret.append((copies[id(elt)], elt))
+      lots[i] = copies[id(elt)]
+  return ret
+
+def perform_wash(lots, logger, provenance_table=None, shared=None,
+                 policy=None, tax_advantaged=()):
+  # If provenance_table is given, every split and pairing is recorded in it.
+  # shared is an optional set of ids of lots that belong to the caller and
+  # must not be changed: they are copied only when a pairing needs to change
+  # them, and the copies are returned instead.
+  # policy picks which replacement is paired first, see POLICIES; the
+  # default is ChronologicalPolicy.
+  # tax_advantaged holds the names of accounts such as IRAs. Their sales
+  # are not washed, and a loss washed by one of their buys is disallowed for
+  # good (Rev. Rul. 2008-5): the buy keeps its basis and buy date.
+  if policy is None:
+    policy = ChronologicalPolicy()
   removed = []
+  if provenance_table is not None:
+    provenance_table.add_lots(lots)
   while True:
-    loss_lots = earliest_wash_loss(lots)
+    loss_lots, buy_lots = earliest_wash_loss(lots, tax_advantaged)
     if not loss_lots:
       break
     logger.print_progress(lots, "Found the following losses", loss_lots)
-    buy_lots = buy_lots_within_window(lots, loss_lots[0])
     logger.print_progress(lots, "Here are the replacements", buy_lots)
-    if not buy_lots:
-      print "Error: no buy lots"
-      raise
-    # Pair them off, splitting as necessary
-    buy_lots.sort(cmp=cmp_by_buy_date)
-    loss_lots.sort(cmp=cmp_by_buy_date)
-    while buy_lots and loss_lots:
-      if buy_lots[0].count > loss_lots[0].count:
+    if shared:
+      for lot_copy, original in copy_shared_lots(
+          lots, shared, [loss_lots, buy_lots]):
+        if provenance_table is not None:
+          provenance_table.record_copy(lot_copy, original)
+    paired = set()
+    # Pair them off, splitting as necessary. The keys are computed once here,
+    # since pairing changes the buy date of replacements.
+    buy_heap = lot_heap(buy_lots, policy.key)
+    loss_heap = lot_heap(loss_lots, buy_date_key)
+    buy = pop_lot(buy_heap)
+    loss = pop_lot(loss_heap)
+    while buy and loss:
+      # After a split, the remaining shares are next in line
+      next_buy = next_loss = None
+      if buy.count > loss.count:
         # split buy
-        logger.print_progress(lots, "Splitting buy", [buy_lots[0]])
-        new_buy = split_head_lot(buy_lots, loss_lots[0].count)
-        lots.append(new_buy)
-        logger.print_progress(lots, "into these", [buy_lots[0],
-                                                            buy_lots[1]])
-      elif buy_lots[0].count < loss_lots[0].count:
+        logger.print_progress(lots, "Splitting buy", [buy])
+        pieces = [buy]
+        next_buy = buy
+        buy = split_head_lot(pieces, loss.count)
+        lots.append(buy)
+        if provenance_table is not None:
+          provenance_table.record_split(buy, pieces[1])
+        logger.print_progress(lots, "into these", pieces)
+      elif buy.count < loss.count:
         # split loss
-        logger.print_progress(lots, "Splitting loss", [loss_lots[0]])
-        new_loss = split_head_lot(loss_lots, buy_lots[0].count)
-        lots.append(new_loss)
-        logger.print_progress(lots, "into these", [loss_lots[0],
-                                                            loss_lots[1]])
-      assert buy_lots[0].count == loss_lots[0].count
-      buy = buy_lots[0]
-      loss = loss_lots[0]
+        logger.print_progress(lots, "Splitting loss", [loss])
+        pieces = [loss]
+        next_loss = loss
+        loss = split_head_lot(pieces, buy.count)
+        lots.append(loss)
+        if provenance_table is not None:
+          provenance_table.record_split(loss, pieces[1])
+        logger.print_progress(lots, "into these", pieces)
+      assert buy.count == loss.count
       logger.print_progress(lots, "pairing these", [buy, loss])
-      remove_lot_from_list(buy_lots, buy)
-      remove_lot_from_list(loss_lots, loss)
-      remove_lot_from_list(lots, loss)
       removed.append(loss)
-      buy.basis = buy.basis + loss.basis - loss.proceeds
-      buy.buydate = buy.buydate - (loss.selldate - loss.buydate)
+      paired.add(id(loss))
+      adjusted = buy.account not in tax_advantaged
+      if adjusted:
+        buy.basis = buy.basis + loss.basis - loss.proceeds
+        buy.buydate = buy.buydate - (loss.selldate - loss.buydate)
       buy.is_replacement = True
       merge_buy_lots(loss, buy)
+      if provenance_table is not None:
+        provenance_table.record_wash(loss, buy, adjusted)
       logger.print_progress(lots, "pair complete", [buy])
       loss.code = 'W'
       loss.adjustment = loss.basis - loss.proceeds
+      buy = next_buy or pop_lot(buy_heap)
+      loss = next_loss or pop_lot(loss_heap)
+    lots[:] = [elt for elt in lots if id(elt) not in paired]
   removed.extend(lots)
   removed.sort(cmp=cmp_by_sell_date)
   return removed
 
+def account_file_name(file_name, account):
+  # out.csv -> out_<account>.csv
+  root, ext = os.path.splitext(file_name)
+  return '%s_%s%s' % (root, account, ext)
+
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument('-o', '--out_file')
   parser.add_argument('-w', '--do_wash', metavar='in_file')
+  parser.add_argument('-a', '--account', nargs=2, action='append',
+                      metavar=('account', 'in_file'),
+                      help='''Wash the lots of several accounts together, for
+                      example a spouse's accounts or an IRA (see -i),
+                      instead of using -w. Repeat for each account. A loss
+                      in one account can be washed by a buy in any of them.
+                      The lots of each account are saved to the out_file
+                      name with the account name added, e.g. out_ira.csv.''')
+  parser.add_argument('-i', '--tax_advantaged', action='append', default=[],
+                      metavar='account',
+                      help='''An account given with -a that is tax-advantaged,
+                      such as an IRA. Repeat for each one. Its sales are not
+                      washed, and a loss washed by one of its buys is
+                      disallowed for good: the loss is still coded W, but
+                      the buy keeps its basis and buy date.''')
   parser.add_argument('-q', '--quiet', action="store_true")
   parser.add_argument('-m', '--merge_split_lots', action="store_true",
                       help='''Any split lots are merged back together at end.
@@ -189,24 +335,74 @@ def main():
                       amount so that the final loss will be $0 in such cases.
                       It is safe to use this option with the merge_split_lots
                       option.''')
+  parser.add_argument('-p', '--provenance_file',
+                      help='''Save a table recording every split and every
+                      loss that was washed into a replacement. Use
+                      provenance.py on this file to explain the basis of any
+                      lot in the output without rerunning the wash.
+                      Form positions in this table refer to the split lots,
+                      so it is best used without merge_split_lots. With -a,
+                      give the account to provenance.py with its -a
+                      option.''')
+  parser.add_argument('-s', '--summary_file',
+                      help='''Save form 8949 totals per box (short or long
+                      term) and symbol, as CSV or as JSON if the name ends
+                      with .json. Assumes the basis was reported to the IRS
+                      (boxes A and D); see form8949.py for the other boxes.
+                      With -a, one summary is saved per account. The totals
+                      are taken before merge_split_lots, which could put
+                      all the shares of a lot in the same term.''')
+  parser.add_argument('--policy', choices=sorted(POLICIES),
+                      default='chronological',
+                      help='''Which replacement absorbs a loss first:
+                      the earliest bought (the default), the one with the
+                      highest basis per share, or the first in FormPosition
+                      order, to match the adjustments made by a broker.''')
   parsed = parser.parse_args()
+  accounts = [account for account, _ in parsed.account or []]
+  if parsed.do_wash and accounts:
+    parser.error('use either -w or -a')
+  if len(set(accounts)) != len(accounts):
+    parser.error('each account can only be given once')
+  if set(parsed.tax_advantaged) - set(accounts):
+    parser.error('-i must name accounts given with -a')
 
-  if parsed.do_wash:
-    lots = lot.load_lots(open(parsed.do_wash))
+  if parsed.do_wash or accounts:
+    if accounts:
+      lots = lot.load_household([(account, open(in_file))
+                                 for account, in_file in parsed.account])
+    else:
+      lots = lot.load_lots(open(parsed.do_wash))
     lot.print_lots(lots, False)
     if parsed.quiet:
       logger = progress_logger.NullLogger()
     else:
       logger = progress_logger.TermLogger()
-    out = perform_wash(lots, logger)
+    table = provenance.Provenance() if parsed.provenance_file else None
+    out = perform_wash(lots, logger, table,
+                       policy=POLICIES[parsed.policy](),
+                       tax_advantaged=frozenset(parsed.tax_advantaged))
+
+    # Form 8949 totals use the split lots, even with -m: a merged lot has a
+    # single buy date, which can put all its shares in the same term.
+    summary_lots = out
 
     # merge split lots back together, if asked.
-    if parsed.merge_split_lots:
+    if parsed.merge_split_lots and accounts:
+      # Form positions are only unique within an account
+      merged = []
+      for account_lots in lot.split_by_account(out, accounts):
+        if account_lots:
+          merged.extend(lot.merge_split_lots(account_lots))
+      out = merged
+    elif parsed.merge_split_lots:
       out = lot.merge_split_lots(out)
 
     # make the adjustment safe for whole-dollar rounding arithmentic
     if parsed.adjust_for_dollar_rounding:
       lot.adjust_for_dollar_rounding(out)
+      if summary_lots is not out:
+        lot.adjust_for_dollar_rounding(summary_lots)
 
     # readable text output
     print 'output:'
@@ -214,9 +410,30 @@ def main():
                    rounded_dollars=parsed.adjust_for_dollar_rounding)
 
     # CSV text output
-    if parsed.out_file:
+    if parsed.out_file and accounts:
+      for account, account_lots in zip(accounts,
+                                       lot.split_by_account(out, accounts)):
+        out_file = account_file_name(parsed.out_file, account)
+        print 'Saving final lots of', account, 'to', out_file
+        lot.save_lots(account_lots, open(out_file, 'w'))
+    elif parsed.out_file:
       print 'Saving final lots to', parsed.out_file
       lot.save_lots(out, open(parsed.out_file, 'w'))
 
+    if parsed.summary_file and accounts:
+      for account, account_lots in zip(
+          accounts, lot.split_by_account(summary_lots, accounts)):
+        summary_file = account_file_name(parsed.summary_file, account)
+        print 'Saving form 8949 summary of', account, 'to', summary_file
+        form8949.save_summary(form8949.rollup(account_lots), summary_file)
+    elif parsed.summary_file:
+      print 'Saving form 8949 summary to', parsed.summary_file
+      form8949.save_summary(form8949.rollup(summary_lots),
+                            parsed.summary_file)
+
+    if parsed.provenance_file:
+      print 'Saving provenance to', parsed.provenance_file
+      provenance.save_provenance(table, open(parsed.provenance_file, 'w'))
+
 if __name__ == "__main__":
   main()